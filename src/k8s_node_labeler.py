@@ -10,26 +10,99 @@ Also exports Prometheus metrics for monitoring.
 """
 
 import argparse
+import functools
 import json
 import logging
 import os
+import queue
+import select
+import signal
 import socket
 import sys
+import threading
 import time
 from typing import Dict, Optional
 
 try:
-    from prometheus_client import start_http_server, Gauge, Info
+    from prometheus_client import start_http_server, CollectorRegistry
+    from prometheus_client.core import GaugeMetricFamily, InfoMetricFamily
 except ImportError:
     print("ERROR: prometheus_client not installed", file=sys.stderr)
     sys.exit(1)
 
+# The kubernetes client is heavy to import, so it is only loaded when
+# connecting to the API (see _load_kube)
+client = None
+config = None
+ApiException = None
+
 try:
-    from kubernetes import client, config
-    from kubernetes.client.rest import ApiException
+    from inotify_simple import INotify, flags as inotify_flags
 except ImportError:
-    print("ERROR: kubernetes library not installed", file=sys.stderr)
-    sys.exit(1)
+    INotify = None
+
+try:
+    import orjson
+    _json_loads = orjson.loads
+    _json_binary = True
+except ImportError:
+    _json_loads = json.loads
+    _json_binary = False
+
+BCM_CONFIG_FILE = '/etc/bcm-agent/config.json'
+
+# Server-side apply field manager owning the labels set by this daemon
+FIELD_MANAGER = 'bcm-node-labeler'
+
+# Coalesce label updates: flush this long after the first queued update,
+# or as soon as this many updates are pending
+LABEL_FLUSH_DELAY = 0.5
+LABEL_FLUSH_MAX_UPDATES = 32
+
+# How long to wait for the sync worker to flush pending labels on shutdown
+SHUTDOWN_TIMEOUT = 10
+
+# Tokens posted to the sync worker
+_SYNC = 'sync'
+_STOP = 'stop'
+
+# Hardware gauges, exported only when BCM reports a value:
+# BCM data key -> (metric name, description)
+HARDWARE_GAUGES = {
+    'gpu_count': ('bcm_gpu_count', 'Number of GPUs detected'),
+    'cpu_count': ('bcm_cpu_count', 'Number of CPUs'),
+    'memory_gb': ('bcm_memory_gb', 'Total memory in GB'),
+}
+
+# Characters not allowed in Kubernetes label values
+_LABEL_TRANS = str.maketrans({'/': '_', ' ': '-', ':': '-'})
+
+
+@functools.lru_cache(maxsize=64)
+def _prefixed_label_key(prefix: str, key: str) -> str:
+    """Build a prefixed label key, cached since keys repeat every sync"""
+    return f"{prefix}/{key}"
+
+
+@functools.lru_cache(maxsize=256)
+def _sanitize_label_str(value: str) -> str:
+    """Sanitize a label value string, cached since values repeat every sync"""
+    value = value[:63].translate(_LABEL_TRANS).strip('-_.')
+    return value if value else "unknown"
+
+
+def _load_kube():
+    """Import the kubernetes client on first use"""
+    global client, config, ApiException
+    if client is not None:
+        return
+    try:
+        from kubernetes import client as kube_client, config as kube_config
+        from kubernetes.client.rest import ApiException as KubeApiException
+    except ImportError:
+        print("ERROR: kubernetes library not installed", file=sys.stderr)
+        sys.exit(1)
+    client, config, ApiException = kube_client, kube_config, KubeApiException
 
 
 class KubernetesClient:
@@ -40,9 +113,12 @@ class KubernetesClient:
         self.v1 = None
         self.node_name = node_name
         self.logger = logging.getLogger('k8s-client')
+        # Labels from the last successful patch, to skip no-op updates
+        self._last_applied: Optional[Dict[str, str]] = None
 
     def connect(self) -> bool:
         """Connect to Kubernetes API"""
+        _load_kube()
         try:
             # Try in-cluster config first (for DaemonSet)
             config.load_incluster_config()
@@ -53,11 +129,14 @@ class KubernetesClient:
                 config.load_kube_config()
                 self.logger.info("Loaded kubeconfig")
             except Exception as e:
-                self.logger.error(f"Failed to load Kubernetes config: {e}")
+                self.logger.error("Failed to load Kubernetes config: %s", e)
                 return False
 
-        self.v1 = client.CoreV1Api()
-        self.logger.info(f"Connected to Kubernetes API for node: {self.node_name}")
+        # Single persistent connection to the API server for the daemon lifetime
+        cfg = client.Configuration.get_default_copy()
+        cfg.connection_pool_maxsize = 1
+        self.v1 = client.CoreV1Api(api_client=client.ApiClient(cfg))
+        self.logger.info("Connected to Kubernetes API for node: %s", self.node_name)
         return True
 
     def apply_labels(self, labels: Dict[str, str]) -> bool:
@@ -68,17 +147,46 @@ class KubernetesClient:
 
         # Add prefix to all labels
         prefixed_labels = {
-            f"{self.label_prefix}/{k}": self._sanitize_label_value(v)
+            _prefixed_label_key(self.label_prefix, k): self._sanitize_label_value(v)
             for k, v in labels.items()
         }
 
+        if prefixed_labels == self._last_applied:
+            self.logger.debug("Labels unchanged on node %s, skipping patch", self.node_name)
+            return True
+
+        # Server-side apply: the API server removes labels we owned but no
+        # longer send, so the full label set is sent every time. patch_node
+        # cannot select the apply content type on the pinned client, so the
+        # request is made directly; the client JSON-encodes the dict body.
+        body = {
+            "apiVersion": "v1",
+            "kind": "Node",
+            "metadata": {"name": self.node_name, "labels": prefixed_labels},
+        }
         try:
-            body = {"metadata": {"labels": prefixed_labels}}
-            self.v1.patch_node(self.node_name, body)
-            self.logger.info(f"Applied {len(prefixed_labels)} labels to node {self.node_name}")
+            self.v1.api_client.call_api(
+                '/api/v1/nodes/{name}', 'PATCH',
+                path_params={'name': self.node_name},
+                query_params=[('fieldManager', FIELD_MANAGER), ('force', 'true')],
+                header_params={
+                    'Accept': 'application/json',
+                    'Content-Type': 'application/apply-patch+yaml',
+                },
+                body=body,
+                response_type='V1Node',
+                auth_settings=['BearerToken'],
+                _return_http_data_only=True)
+            self._last_applied = prefixed_labels
+            self.logger.info("Applied %d labels to node %s", len(prefixed_labels), self.node_name)
             return True
         except ApiException as e:
-            self.logger.error(f"Failed to apply labels: {e}")
+            self.logger.error("Failed to apply labels: %s", e)
+            return False
+        except Exception as e:
+            # Client-side errors (bad arguments, connection failures) only
+            # fail this sync, like API errors
+            self.logger.error("Failed to apply labels: %s: %s", type(e).__name__, e)
             return False
 
     @staticmethod
@@ -86,10 +194,48 @@ class KubernetesClient:
         """Sanitize label value to conform to Kubernetes requirements"""
         if not value:
             return "unknown"
-        value = str(value)[:63]
-        value = value.replace('/', '_').replace(' ', '-').replace(':', '-')
-        value = value.strip('-_.')
-        return value if value else "unknown"
+        return _sanitize_label_str(str(value))
+
+
+class BCMCollector:
+    """
+    Prometheus collector exporting a snapshot of the latest BCM data.
+
+    update() swaps the whole snapshot at once, so scrapes always see a
+    consistent set of values without per-metric locking.
+    """
+
+    def __init__(self):
+        self._snapshot: Dict = {}
+
+    def update(self, snapshot: Dict):
+        """Replace the exported snapshot"""
+        self._snapshot = snapshot
+
+    def collect(self):
+        """Yield metrics from the current snapshot"""
+        snapshot = self._snapshot
+
+        if 'node_info' in snapshot:
+            yield InfoMetricFamily('bcm_node', 'BCM node information',
+                                   value=snapshot['node_info'])
+        if 'last_sync' in snapshot:
+            yield GaugeMetricFamily('bcm_last_sync_timestamp', 'Last BCM sync timestamp',
+                                    value=snapshot['last_sync'])
+
+        # Hardware metrics are skipped until BCM reports them, so nodes
+        # without e.g. GPUs do not export placeholder zeros
+        for key, (name, documentation) in HARDWARE_GAUGES.items():
+            if key in snapshot:
+                yield GaugeMetricFamily(name, documentation, value=snapshot[key])
+
+        health = snapshot.get('hardware_health')
+        if health:
+            family = GaugeMetricFamily('bcm_hardware_health', 'Hardware health status',
+                                       labels=['component'])
+            for component, status in health.items():
+                family.add_metric([component], status)
+            yield family
 
 
 class BCMNodeLabeler:
@@ -102,24 +248,46 @@ class BCMNodeLabeler:
 
     def __init__(self, args):
         self.args = args
-        self.running = True
+        # Set by SIGTERM/SIGINT, with a write to the pipe to wake up the main
+        # thread. The handler takes no locks, so the main thread sets _stop
+        # for the worker once it has left its loop.
+        self._stopping = False
+        self._stop = threading.Event()
+        self._wake_r, self._wake_w = None, None
         self.logger = self._setup_logging()
         self.node_name = self._get_node_name()
 
-        # Kubernetes client
+        # Parsed BCM config, keyed by (st_mtime_ns, st_size) of the file
+        self._cfg_cache = (None, None)
+
+        # inotify watch on the BCM config (None when polling)
+        self._watcher = None
+        self._epoll = None
+
+        # Sync requests for the worker thread; a full queue means a sync is
+        # already pending, so extra requests are dropped
+        self._sync_q: queue.Queue = queue.Queue(maxsize=1)
+
+        # Labels waiting to be flushed to the node (worker thread only)
+        self._pending: Dict[str, str] = {}
+        self._pending_count = 0
+        self._flush_deadline: Optional[float] = None
+
+        # Kubernetes client, never created (nor imported) without labeling
         self.k8s_client = None
-        if not args.disable_labeling:
+        if args.disable_labeling or args.metrics_only:
+            self.logger.info("Labeling disabled, not connecting to Kubernetes API")
+        else:
             try:
                 self.k8s_client = KubernetesClient(
                     node_name=self.node_name,
                     label_prefix=args.label_prefix
                 )
-                self.k8s_client.connect()
-                self.logger.info(f"Connected to Kubernetes API for node {self.node_name}")
+                if not self.k8s_client.connect():
+                    raise RuntimeError("could not load Kubernetes config")
             except Exception as e:
-                self.logger.error(f"Failed to connect to Kubernetes API: {e}")
-                if not args.metrics_only:
-                    raise
+                self.logger.error("Failed to connect to Kubernetes API: %s", e)
+                raise
 
         # Prometheus metrics
         self.metrics = self._setup_metrics()
@@ -138,21 +306,16 @@ class BCMNodeLabeler:
         node_name = os.getenv('NODE_NAME')
         if not node_name:
             node_name = socket.gethostname()
-            self.logger.warning(f"NODE_NAME not set, using hostname: {node_name}")
+            self.logger.warning("NODE_NAME not set, using hostname: %s", node_name)
         return node_name
 
-    def _setup_metrics(self) -> Dict:
+    def _setup_metrics(self) -> BCMCollector:
         """Set up Prometheus metrics"""
-        metrics = {
-            'node_info': Info('bcm_node', 'BCM node information'),
-            'hardware_health': Gauge('bcm_hardware_health', 'Hardware health status',
-                                    ['component']),
-            'gpu_count': Gauge('bcm_gpu_count', 'Number of GPUs detected'),
-            'cpu_count': Gauge('bcm_cpu_count', 'Number of CPUs'),
-            'memory_gb': Gauge('bcm_memory_gb', 'Total memory in GB'),
-            'last_sync': Gauge('bcm_last_sync_timestamp', 'Last BCM sync timestamp'),
-        }
-        return metrics
+        # Private registry, so scrapes skip the default process/GC collectors
+        self._registry = CollectorRegistry()
+        collector = BCMCollector()
+        self._registry.register(collector)
+        return collector
 
     def read_bcm_data(self) -> Optional[Dict]:
         """
@@ -171,16 +334,22 @@ class BCMNodeLabeler:
             }
 
             # Try to read cm-lite-daemon config if available
-            config_file = '/etc/bcm-agent/config.json'
-            if os.path.exists(config_file):
-                with open(config_file, 'r') as f:
-                    config = json.load(f)
-                    data.update(config)
+            config_file = BCM_CONFIG_FILE
+            try:
+                # Only re-parse the config when it changed on disk
+                st = os.stat(config_file)
+                key = (st.st_mtime_ns, st.st_size)
+                if key != self._cfg_cache[0]:
+                    with open(config_file, 'rb' if _json_binary else 'r') as f:
+                        self._cfg_cache = (key, _json_loads(f.read()))
+                data.update(self._cfg_cache[1])
+            except FileNotFoundError:
+                pass
 
             return data
 
         except Exception as e:
-            self.logger.error(f"Failed to read BCM data: {e}")
+            self.logger.error("Failed to read BCM data: %s", e)
             return None
 
     def generate_labels(self, bcm_data: Dict) -> Dict[str, str]:
@@ -211,30 +380,53 @@ class BCMNodeLabeler:
         # Health status
         # labels['health-status'] = bcm_data.get('health_status', 'unknown')
 
-        self.logger.debug(f"Generated labels: {labels}")
+        self.logger.debug("Generated labels: %s", labels)
         return labels
 
     def update_metrics(self, bcm_data: Dict):
         """Update Prometheus metrics with BCM data"""
         try:
-            # Update node info
-            self.metrics['node_info'].info({
-                'node_name': bcm_data.get('node_name', 'unknown'),
-                'bcm_cluster': bcm_data.get('host', 'unknown'),
-            })
+            # A malformed value only drops that metric, not the whole snapshot
+            last_sync = self._metric_value('timestamp', bcm_data.get('timestamp'))
+            snapshot = {
+                'node_info': {
+                    'node_name': str(bcm_data.get('node_name', 'unknown')),
+                    'bcm_cluster': str(bcm_data.get('host', 'unknown')),
+                },
+                'last_sync': last_sync if last_sync is not None else time.time(),
+                'hardware_health': {},
+            }
 
-            # Update timestamp
-            self.metrics['last_sync'].set(bcm_data.get('timestamp', time.time()))
+            for key in HARDWARE_GAUGES:
+                value = self._metric_value(key, bcm_data.get(key))
+                if value is not None:
+                    snapshot[key] = value
 
-            # Hardware metrics (placeholders for now)
-            self.metrics['gpu_count'].set(bcm_data.get('gpu_count', 0))
-            self.metrics['cpu_count'].set(bcm_data.get('cpu_count', 0))
-            self.metrics['memory_gb'].set(bcm_data.get('memory_gb', 0))
+            health = bcm_data.get('hardware_health') or {}
+            if isinstance(health, dict):
+                for component, status in health.items():
+                    value = self._metric_value(f"hardware_health.{component}", status)
+                    if value is not None:
+                        snapshot['hardware_health'][str(component)] = value
+            else:
+                self.logger.warning("Ignoring hardware_health, expected a mapping: %r", health)
+
+            self.metrics.update(snapshot)
 
             self.logger.debug("Updated Prometheus metrics")
 
         except Exception as e:
-            self.logger.error(f"Failed to update metrics: {e}")
+            self.logger.error("Failed to update metrics: %s", e)
+
+    def _metric_value(self, key: str, value) -> Optional[float]:
+        """Convert a BCM value to a metric value, or None if absent or invalid"""
+        if value is None:
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            self.logger.warning("Ignoring non-numeric value for %s: %r", key, value)
+            return None
 
     def sync_node_labels(self):
         """Read BCM data and update Kubernetes node labels"""
@@ -249,49 +441,195 @@ class BCMNodeLabeler:
             self.update_metrics(bcm_data)
 
             # Update Kubernetes labels
-            if self.k8s_client and not self.args.disable_labeling:
+            if self.k8s_client is not None:
                 labels = self.generate_labels(bcm_data)
                 if labels:
-                    success = self.k8s_client.apply_labels(labels)
-                    if success:
-                        self.logger.info(f"Applied {len(labels)} labels to node {self.node_name}")
-                    else:
-                        self.logger.error("Failed to apply labels")
+                    self._queue_labels(labels)
                 else:
                     self.logger.warning("No labels generated from BCM data")
 
         except Exception as e:
-            self.logger.error(f"Error during node label sync: {e}", exc_info=True)
+            self.logger.error("Error during node label sync: %s", e, exc_info=True)
+
+    def _queue_labels(self, labels: Dict[str, str]):
+        """Queue labels for the next flush, coalescing bursts of updates"""
+        # Each sync produces the full label set, so the latest one wins
+        self._pending = labels
+        self._pending_count += 1
+        if self._flush_deadline is None:
+            self._flush_deadline = time.monotonic() + LABEL_FLUSH_DELAY
+
+    def _flush_labels(self, force: bool = False):
+        """Apply pending labels once the coalescing window has elapsed"""
+        if self._flush_deadline is None:
+            return
+        if (not force and self._pending_count < LABEL_FLUSH_MAX_UPDATES and
+                time.monotonic() < self._flush_deadline):
+            return
+
+        labels = self._pending
+        self.logger.debug("Flushing %d coalesced label updates", self._pending_count)
+        self._pending = {}
+        self._pending_count = 0
+        self._flush_deadline = None
+
+        # apply_labels logs actual patches itself; unchanged labels are a no-op
+        if not self.k8s_client.apply_labels(labels):
+            self.logger.error("Failed to apply labels")
+
+    def _request_sync(self):
+        """Ask the worker thread to sync, unless a sync is already pending"""
+        try:
+            self._sync_q.put_nowait(_SYNC)
+        except queue.Full:
+            pass
+
+    def _sync_worker(self):
+        """Run requested syncs and flush labels, off the main thread"""
+        while True:
+            try:
+                # While labels are pending, wake up in time to flush them
+                timeout = None
+                if self._flush_deadline is not None:
+                    timeout = max(0.0, self._flush_deadline - time.monotonic())
+
+                try:
+                    token = self._sync_q.get(timeout=timeout)
+                except queue.Empty:
+                    token = None
+
+                if token == _STOP:
+                    break
+                if token == _SYNC:
+                    self.sync_node_labels()
+                self._flush_labels()
+
+            except Exception as e:
+                self.logger.error("Error in sync worker: %s", e, exc_info=True)
+                self._stop.wait(5)  # Brief pause before retry
+
+        # Drain labels still waiting for their coalescing window
+        try:
+            self._flush_labels(force=True)
+        except Exception as e:
+            self.logger.error("Failed to flush labels on shutdown: %s", e)
+
+    def _setup_signals(self):
+        """Stop the daemon cleanly on SIGTERM/SIGINT"""
+        self._wake_r, self._wake_w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+
+        def handle(signum, frame):
+            self._stopping = True
+            try:
+                os.write(self._wake_w, b'\0')
+            except BlockingIOError:
+                pass  # Wakeup already pending
+
+        signal.signal(signal.SIGTERM, handle)
+        signal.signal(signal.SIGINT, handle)
+
+    def _setup_config_watch(self):
+        """Watch the BCM config directory with inotify, if available"""
+        if INotify is None:
+            self.logger.info("inotify_simple not installed, falling back to polling")
+            return
+
+        watch_dir = os.path.dirname(BCM_CONFIG_FILE)
+        mask = (inotify_flags.MODIFY | inotify_flags.CLOSE_WRITE |
+                inotify_flags.MOVED_TO | inotify_flags.CREATE | inotify_flags.DELETE)
+        try:
+            watcher = INotify(nonblocking=True)
+            watcher.add_watch(watch_dir, mask)
+        except OSError as e:
+            self.logger.warning("Cannot watch %s, falling back to polling: %s", watch_dir, e)
+            return
+
+        self._watcher = watcher
+        self._epoll = select.epoll()
+        self._epoll.register(watcher.fileno(), select.EPOLLIN)
+        self._epoll.register(self._wake_r, select.EPOLLIN)
+        self.logger.info("Watching %s for changes", BCM_CONFIG_FILE)
+
+    def _wait_for_change(self, timeout: float) -> bool:
+        """
+        Block until the BCM config changes on disk, the timeout expires
+        or the daemon is asked to stop.
+
+        Returns:
+            True if the config changed, False otherwise
+        """
+        if self._watcher is None:
+            self._sleep(timeout)
+            return False
+
+        config_name = os.path.basename(BCM_CONFIG_FILE)
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            ready = self._epoll.poll(remaining)
+            if not ready or any(fd == self._wake_r for fd, _ in ready):
+                return False
+
+            # Drain all pending events, ignoring other files in the directory
+            events = self._watcher.read(timeout=0)
+            if any(event.name == config_name for event in events):
+                self.logger.debug("BCM config changed on disk")
+                return True
+
+    def _sleep(self, timeout: float):
+        """Sleep on the main thread, waking up early on shutdown"""
+        # The wake pipe is never drained, so this returns at once after a stop
+        select.select([self._wake_r], [], [], timeout)
 
     def run(self):
         """Main daemon loop"""
-        self.logger.info(f"Starting BCM Node Labeler for {self.node_name}")
-        self.logger.info(f"Label prefix: {self.args.label_prefix}")
-        self.logger.info(f"Sync interval: {self.args.interval}s")
+        self.logger.info("Starting BCM Node Labeler for %s", self.node_name)
+        self.logger.info("Label prefix: %s", self.args.label_prefix)
+        self.logger.info("Sync interval: %ds", self.args.interval)
 
         # Start Prometheus metrics server
         if self.args.metrics_port:
             try:
-                start_http_server(self.args.metrics_port)
-                self.logger.info(f"Prometheus metrics exposed on port {self.args.metrics_port}")
+                start_http_server(self.args.metrics_port, registry=self._registry)
+                self.logger.info("Prometheus metrics exposed on port %d", self.args.metrics_port)
             except Exception as e:
-                self.logger.error(f"Failed to start metrics server: {e}")
+                self.logger.error("Failed to start metrics server: %s", e)
+
+        self._setup_signals()
+        self._setup_config_watch()
+
+        # Syncs run on a worker so a slow API server never blocks wakeups
+        worker = threading.Thread(target=self._sync_worker, name='sync-worker',
+                                  daemon=True)
+        worker.start()
 
         # Initial sync
-        self.sync_node_labels()
+        self._request_sync()
 
-        # Main loop
-        while self.running:
+        # Main loop: sync on config change, or every interval as a safety net
+        while not self._stopping:
             try:
-                time.sleep(self.args.interval)
-                self.sync_node_labels()
+                self._wait_for_change(self.args.interval)
+                if not self._stopping:
+                    self._request_sync()
 
-            except KeyboardInterrupt:
-                self.logger.info("Received shutdown signal")
-                self.running = False
             except Exception as e:
-                self.logger.error(f"Error in main loop: {e}", exc_info=True)
-                time.sleep(5)  # Brief pause before retry
+                self.logger.error("Error in main loop: %s", e, exc_info=True)
+                self._sleep(5)  # Brief pause before retry
+
+        self.logger.info("Received shutdown signal")
+        self._stop.set()
+
+        # Let the worker finish its current sync and flush pending labels
+        try:
+            self._sync_q.put(_STOP, timeout=SHUTDOWN_TIMEOUT)
+            worker.join(SHUTDOWN_TIMEOUT)
+        except queue.Full:
+            pass
+        if worker.is_alive():
+            self.logger.warning("Sync worker did not stop in time, pending labels may be lost")
 
         self.logger.info("BCM Node Labeler stopped")
 